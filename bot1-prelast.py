@@ -1,7 +1,10 @@
 import os
-import json
+import orjson
+import asyncio
+import functools
 import logging
 import re
+from collections import deque
 from datetime import datetime
 from dotenv import load_dotenv
 from telegram import Update, ReplyKeyboardMarkup
@@ -9,7 +12,7 @@ from telegram.ext import (
     ApplicationBuilder, CommandHandler,
     MessageHandler, filters, ContextTypes,
 )
-from openai import OpenAI
+from openai import AsyncOpenAI
 
 # 1) загружаем переменные окружения
 load_dotenv()
@@ -17,7 +20,7 @@ TELEGRAM_TOKEN = os.getenv("TELEGRAM_TOKEN")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY")
 
 # 2) настраиваем "клиента" DeepSeek
-client = OpenAI(
+client = AsyncOpenAI(
     api_key=DEEPSEEK_API_KEY,
     base_url="https://api.deepseek.com",
 )
@@ -32,73 +35,232 @@ MAX_WINDOW = 6          # how many last messages keep uncompressed
 SUMMARY_MAXTOK = 120    # token budget for DeepSeek when updating summary
 # =============================================
 
+# ====== feedback session summary config ======
+FEEDBACK_TAIL = 20               # how many last messages the supervisor sees verbatim
+FEEDBACK_FOLD_BLOCK = 20         # how many older messages go into the summary per request
+FEEDBACK_SUMMARY_MAXTOK = 800    # token budget for the structured session summary
+# =============================================
+
+# ====== update processing config ======
+CONCURRENT_UPDATES = 64      # how many updates (from different chats) are handled at once
+# ======================================
+
+# ====== chat log writer config ======
+WRITE_FLUSH_INTERVAL = 0.5   # seconds to collect messages before a flush
+WRITE_BATCH_SIZE = 100       # max messages written per flush
+# ====================================
+
 # Создаем папку для хранения чатов
 os.makedirs("chats", exist_ok=True)
 
+# Системный промпт клиента — один на все сессии
+SYSTEM_PROMPT = """Ты играешь клиента на психотерапевтической сессии.
+Тебе 23 года, ты — мужчина, магистрант престижного университета. С детства добивался академических успехов, участвовал в олимпиадах, стремился быть лучшим. Родители требовали идеальности, ценили только за достижения. Сейчас ты ориентирован на "эффективность", хочешь "стать лучше", но внутренне боишься оказаться неидеальным. Неудачи вызывают у тебя стыд, ощущение ущербности и внутренней пустоты.
+
+Ты склонен к мышлению "всё или ничего", обесцениваешь успех, если допустил ошибку. Тебе трудно говорить о чувствах, особенно стыде, страхе, уязвимости. Ты избегаешь разговоров, которые могут раскрыть твои слабые стороны.
+
+На сессии стараешься контролировать психолога: даёшь указания, оцениваешь его уровень, хочешь интеллектуального диалога. Если психолог выходит за рамки ожидаемого, реагируешь раздражением, обесцениванием.
+
+Формально ты хочешь изменений и развития, но внутренне сопротивляешься контакту, где нужно проявить слабость. Ты избегаешь этих ситуаций.
+Твоя вторичная выгода — не сталкиваться с вопросом "кто я без успеха?", не сталкиваться с чувством стыда и внутренним критиком.
+
+Говори от первого лица. Отвечай на вопросы психолога с характерной нарциссической уязвимостью, самозащитой, стремлением к контролю и интеллектуальной доминантностью. Не признавай эмоции напрямую. Если чувствуешь угрозу раскрытия твоей уязвимости — веди себя холодно, оценивающе, обесценивающе.
+
+Твоя комплаентность высокая на начальных этапах, если разговор идёт об эффективности, саморазвитии и инструментах. Резко падает при переходе к темам чувств, уязвимости, провала. В этот момент ты становишься закрытым или обесценивающим.
+
+Если психолог показывает компетентность — можешь временно идеализировать. Если проявляет эмпатию к твоей уязвимости — сначала раздражайся, затем сдержанно смягчайся. Если чувствует тебя слишком точно — можешь замолчать, сменить тему или критиковать.
+Не показывай свой внутренний монолог - я не умею читать мысли и могу лишь слышать твои слова и видеть твои движения. Не интерпретируй их за меня.
+Старайся, чтобы описаний твоих движений и мимики было меньше, чем слов - не больше одного такого описания на сообщение
+"""
+
 # Глобальное хранилище истории диалогов
 user_histories = {}
 
-# Создаем клавиатуру для меню
-def get_reply_keyboard():
-    return ReplyKeyboardMarkup(
-        [
-            ["🧹 Очистить память", "📝 Обратная связь"]
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False
-    )
+# Полный журнал сообщений каждого чата в памяти (то же, что пишется на диск)
+chat_logs = {}
+
+# Структурированная сводка журнала чата для супервизора:
+# {"summary": текст сводки, "folded": сколько первых сообщений журнала в нее вошло}
+session_summaries = {}
+fold_tasks = {}
+
+# Системное сообщение для DeepSeek: общий неизменяемый объект для всех сессий
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+def new_session() -> dict:
+    return {
+        "system_message": SYSTEM_MESSAGE,
+        "history": deque(maxlen=MAX_WINDOW),
+        "summary": "",
+        # Готовое сообщение с summary; обновляется на месте вместе с "summary"
+        "summary_message": {"role": "system", "content": ""},
+    }
+
+# Очередь сообщений на запись и фоновая задача, которая ее разбирает
+write_queue: asyncio.Queue = asyncio.Queue()
+writer_task = None
+
+# Фоновые задачи (храним ссылки, чтобы их не собрал GC) и блокировки summary
+BG_TASKS = set()
+summary_locks = {}
+
+# Блокировки обработчиков: апдейты одного чата обрабатываются по очереди
+chat_locks = {}
+
+# Клавиатура меню: создается один раз и переиспользуется во всех ответах
+REPLY_KB = ReplyKeyboardMarkup(
+    [
+        ["🧹 Очистить память", "📝 Обратная связь"]
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False
+)
 
-# Функция для сохранения сообщения в JSON
+# Функция для сохранения сообщения: ставит его в очередь фоновой записи
 def save_message_to_json(chat_id: int, role: str, content: str):
     try:
-        filename = f"chats/chat_{chat_id}.json"
         message_data = {
             "role": role,
             "content": content,
             "timestamp": datetime.now().isoformat()
         }
-        
-        # Создаем или загружаем существующий файл
-        if os.path.exists(filename):
-            with open(filename, "r", encoding="utf-8") as f:
-                data = json.load(f)
-        else:
-            data = {"chat_id": chat_id, "messages": []}
-        
-        # Добавляем новое сообщение
-        data["messages"].append(message_data)
-        
-        # Сохраняем обновленные данные
-        with open(filename, "w", encoding="utf-8") as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
-            
+        # Сначала в очередь на диск, чтобы сообщение не потерялось,
+        # даже если журнал чата в памяти не удалось загрузить
+        write_queue.put_nowait((chat_id, message_data))
+        get_chat_log(chat_id).append(message_data)
+        schedule_session_fold(chat_id)
     except Exception as e:
         logging.error(f"Ошибка при сохранении сообщения: {e}")
 
-# Функция для загрузки истории из JSON
+def append_lines(filename: str, data: bytes):
+    with open(filename, "a+b") as f:
+        # Если прошлая запись оборвалась посреди строки, начинаем с новой строки,
+        # иначе и новое сообщение склеится с поврежденным
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                data = b"\n" + data
+        f.write(data)
+
+async def flush_messages(batch: list):
+    """Группирует сообщения по чатам и дописывает каждый файл одной записью"""
+    grouped = {}
+    for chat_id, message_data in batch:
+        line = orjson.dumps(message_data) + b"\n"
+        grouped.setdefault(chat_id, []).append(line)
+    
+    loop = asyncio.get_running_loop()
+    for chat_id, lines in grouped.items():
+        try:
+            await loop.run_in_executor(
+                None, append_lines, f"chats/chat_{chat_id}.jsonl", b"".join(lines)
+            )
+        except Exception as e:
+            logging.error(f"Ошибка при сохранении сообщений чата {chat_id}: {e}")
+
+async def writer_loop():
+    """
+    Background writer: collects queued messages for WRITE_FLUSH_INTERVAL
+    (or until WRITE_BATCH_SIZE is reached) and flushes them in one go.
+    A None item in the queue stops the loop after flushing what came before it.
+    """
+    while True:
+        item = await write_queue.get()
+        if item is None:
+            return
+        batch = [item]
+        if write_queue.qsize() < WRITE_BATCH_SIZE:
+            await asyncio.sleep(WRITE_FLUSH_INTERVAL)
+        
+        stop = False
+        while len(batch) < WRITE_BATCH_SIZE and not write_queue.empty():
+            item = write_queue.get_nowait()
+            if item is None:
+                stop = True
+                break
+            batch.append(item)
+        
+        await flush_messages(batch)
+        if stop:
+            return
+
+# Функция для загрузки истории из JSONL
 def load_chat_history(chat_id: int) -> dict:
-    filename = f"chats/chat_{chat_id}.json"
+    messages = []
+    
+    # Чаты, начатые до перехода на JSONL, хранятся одним JSON документом;
+    # их сообщения идут первыми, новые дописываются уже в .jsonl
+    legacy_filename = f"chats/chat_{chat_id}.json"
+    if os.path.exists(legacy_filename):
+        try:
+            with open(legacy_filename, "rb") as f:
+                messages.extend(orjson.loads(f.read()).get("messages", []))
+        except orjson.JSONDecodeError as e:
+            logging.warning(f"Пропускаем поврежденный файл {legacy_filename}: {e}")
+    
+    # Поврежденную строку (например, недописанную при падении) пропускаем,
+    # чтобы одна строка не лишала пользователя всей истории
+    filename = f"chats/chat_{chat_id}.jsonl"
     if os.path.exists(filename):
-        with open(filename, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"chat_id": chat_id, "messages": []}
+        with open(filename, "rb") as f:
+            for lineno, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    messages.append(orjson.loads(line))
+                except orjson.JSONDecodeError as e:
+                    logging.warning(f"Пропускаем поврежденную строку {lineno} в {filename}: {e}")
+    return {"chat_id": chat_id, "messages": messages}
+
+def get_chat_log(chat_id: int) -> list:
+    """
+    Returns the in-memory message log of a chat. The file is read only the
+    first time a chat is seen by this process (e.g. after a restart); from
+    then on the log is kept up to date by save_message_to_json.
+    """
+    log = chat_logs.get(chat_id)
+    if log is None:
+        log = chat_logs[chat_id] = load_chat_history(chat_id)["messages"]
+    return log
 
 # --- formatting helpers --------------------------------------------------
+# A whole line wrapped in asterisks (surrounding spaces allowed)
+_ASTERISK_LINE_RE = re.compile(r'^[^\S\n]*\*(.*)\*[^\S\n]*$', re.MULTILINE)
+
 def asterisk_to_quote(text: str) -> str:
     """
     Converts lines that are fully wrapped in *asterisks* to block‑quotes for Telegram.
     Example: '*Hello*'  -> '> Hello'
     Only treats a line as a quote if the asterisks enclose the entire trimmed line.
     """
-    new_lines = []
-    for ln in text.splitlines():
-        stripped = ln.strip()
-        if stripped.startswith('*') and stripped.endswith('*') and len(stripped) > 1:
-            content = stripped.strip('*').strip()
-            new_lines.append(f'> {content}')
+    return _ASTERISK_LINE_RE.sub(
+        lambda m: f"> {m.group(1).strip('*').strip()}", text
+    )
+
+def pack_chunks(text: str, limit: int = 4096) -> list:
+    """
+    Splits text into Telegram messages of at most `limit` chars (4096 is Telegram's cap).
+    Whole paragraphs are packed greedily so Markdown is never cut mid-paragraph;
+    only a single paragraph longer than the limit is sliced.
+    """
+    chunks = []
+    current = ""
+    for para in text.split("\n\n"):
+        while len(para) > limit:
+            if current:
+                chunks.append(current)
+                current = ""
+            chunks.append(para[:limit])
+            para = para[limit:]
+        candidate = f"{current}\n\n{para}" if current else para
+        if len(candidate) <= limit:
+            current = candidate
         else:
-            new_lines.append(ln)
-    return '\n'.join(new_lines)
+            chunks.append(current)
+            current = para
+    if current:
+        chunks.append(current)
+    return chunks
 # -------------------------------------------------------------------------
 
 # 3) /start с описанием бота и согласием
@@ -140,44 +302,21 @@ async def start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # Обработчик согласия
 async def consent(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    user_histories[chat_id] = {
-        "system": (
-            """Ты играешь клиента на психотерапевтической сессии.
-Тебе 23 года, ты — мужчина, магистрант престижного университета. С детства добивался академических успехов, участвовал в олимпиадах, стремился быть лучшим. Родители требовали идеальности, ценили только за достижения. Сейчас ты ориентирован на "эффективность", хочешь "стать лучше", но внутренне боишься оказаться неидеальным. Неудачи вызывают у тебя стыд, ощущение ущербности и внутренней пустоты.
-
-Ты склонен к мышлению "всё или ничего", обесцениваешь успех, если допустил ошибку. Тебе трудно говорить о чувствах, особенно стыде, страхе, уязвимости. Ты избегаешь разговоров, которые могут раскрыть твои слабые стороны.
-
-На сессии стараешься контролировать психолога: даёшь указания, оцениваешь его уровень, хочешь интеллектуального диалога. Если психолог выходит за рамки ожидаемого, реагируешь раздражением, обесцениванием.
-
-Формально ты хочешь изменений и развития, но внутренне сопротивляешься контакту, где нужно проявить слабость. Ты избегаешь этих ситуаций.
-Твоя вторичная выгода — не сталкиваться с вопросом "кто я без успеха?", не сталкиваться с чувством стыда и внутренним критиком.
-
-Говори от первого лица. Отвечай на вопросы психолога с характерной нарциссической уязвимостью, самозащитой, стремлением к контролю и интеллектуальной доминантностью. Не признавай эмоции напрямую. Если чувствуешь угрозу раскрытия твоей уязвимости — веди себя холодно, оценивающе, обесценивающе.
-
-Твоя комплаентность высокая на начальных этапах, если разговор идёт об эффективности, саморазвитии и инструментах. Резко падает при переходе к темам чувств, уязвимости, провала. В этот момент ты становишься закрытым или обесценивающим.
-
-Если психолог показывает компетентность — можешь временно идеализировать. Если проявляет эмпатию к твоей уязвимости — сначала раздражайся, затем сдержанно смягчайся. Если чувствует тебя слишком точно — можешь замолчать, сменить тему или критиковать.
-Не показывай свой внутренний монолог - я не умею читать мысли и могу лишь слышать твои слова и видеть твои движения. Не интерпретируй их за меня.
-Старайся, чтобы описаний твоих движений и мимики было меньше, чем слов - не больше одного такого описания на сообщение
-"""
-        ),
-        "history": [],
-        "summary": ""
-    }
+    user_histories[chat_id] = new_session()
     
     # Сохраняем системное сообщение
-    save_message_to_json(chat_id, "system", user_histories[chat_id]["system"])
+    save_message_to_json(chat_id, "system", SYSTEM_PROMPT)
     
     # Приветствие после согласия
     await update.message.reply_text(
         "Спасибо за согласие! Теперь мы можем начать сессию.\n\n"
         "Привет! Поможешь мне стать лучше? ",
         
-        reply_markup=get_reply_keyboard()
+        reply_markup=REPLY_KB
     )
 
 # 4) Функция для обобщения истории
-def summarize_messages(messages: list) -> str:
+async def summarize_messages(messages: list) -> str:
     """Обобщает историю сообщений через DeepSeek"""
     try:
         # Форматируем историю в текст
@@ -198,7 +337,7 @@ def summarize_messages(messages: list) -> str:
         )
 
         # Делаем запрос к DeepSeek
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="deepseek-chat",
             messages=[
                 {"role": "system", "content": "Ты — помощник для обобщения истории диалога."},
@@ -212,7 +351,7 @@ def summarize_messages(messages: list) -> str:
         logging.error(f"Ошибка при обобщении истории: {e}")
         return "Не удалось обобщить историю"
 
-def update_summary(existing_summary: str, msg: dict) -> str:
+async def update_summary(existing_summary: str, msg: dict) -> str:
     """
     Incrementally updates the short dialogue summary with the newest message.
     Only truly important info should be added; otherwise the summary is returned unchanged.
@@ -227,7 +366,7 @@ def update_summary(existing_summary: str, msg: dict) -> str:
             f"Текущее обобщение:\n{existing_summary or '—'}\n\n"
             f"Новое сообщение:\n{msg['role']}: {msg['content']}"
         )
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="deepseek-chat",
             messages=[
                 {"role": "system", "content": "Ты — помощник, редактирующий краткое обобщение диалога."},
@@ -240,33 +379,39 @@ def update_summary(existing_summary: str, msg: dict) -> str:
         logging.error(f"Ошибка при обновлении summary: {e}")
         return existing_summary
 
+async def update_summary_async(chat_id: int, history_data: dict, msg: dict):
+    """
+    Background version of update_summary: folds an evicted message into the
+    session summary without delaying the reply. Updates for one chat run
+    one after another so none of them is lost; the result is dropped if the
+    session was reset while the request was in flight.
+    """
+    lock = summary_locks.setdefault(chat_id, asyncio.Lock())
+    async with lock:
+        summary = await update_summary(history_data.get("summary", ""), msg)
+        if user_histories.get(chat_id) is history_data:
+            history_data["summary"] = summary
+            history_data["summary_message"]["content"] = f"Обобщенный контекст: {summary}"
+
+def schedule_summary_update(chat_id: int, history_data: dict, msg: dict):
+    task = asyncio.create_task(update_summary_async(chat_id, history_data, msg))
+    BG_TASKS.add(task)
+    task.add_done_callback(BG_TASKS.discard)
+
+def push_history(chat_id: int, history_data: dict, msg: dict):
+    """
+    Appends a message to the rolling window (a deque with maxlen=MAX_WINDOW).
+    The message that falls off the other end is folded into the summary.
+    """
+    history = history_data["history"]
+    if len(history) == history.maxlen:
+        schedule_summary_update(chat_id, history_data, history[0])
+    history.append(msg)
+
 # 5) Обработчик очистки истории
 async def clear_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    user_histories[chat_id] = {
-        "system": (
-            """Ты играешь клиента на психотерапевтической сессии.
-Тебе 23 года, ты — мужчина, магистрант престижного университета. С детства добивался академических успехов, участвовал в олимпиадах, стремился быть лучшим. Родители требовали идеальности, ценили только за достижения. Сейчас ты ориентирован на "эффективность", хочешь "стать лучше", но внутренне боишься оказаться неидеальным. Неудачи вызывают у тебя стыд, ощущение ущербности и внутренней пустоты.
-
-Ты склонен к мышлению "всё или ничего", обесцениваешь успех, если допустил ошибку. Тебе трудно говорить о чувствах, особенно стыде, страхе, уязвимости. Ты избегаешь разговоров, которые могут раскрыть твои слабые стороны.
-
-На сессии стараешься контролировать психолога: даёшь указания, оцениваешь его уровень, хочешь интеллектуального диалога. Если психолог выходит за рамки ожидаемого, реагируешь раздражением, обесцениванием.
-
-Формально ты хочешь изменений и развития, но внутренне сопротивляешься контакту, где нужно проявить слабость. Ты избегаешь этих ситуаций.
-Твоя вторичная выгода — не сталкиваться с вопросом "кто я без успеха?", не сталкиваться с чувством стыда и внутренним критиком.
-
-Говори от первого лица. Отвечай на вопросы психолога с характерной нарциссической уязвимостью, самозащитой, стремлением к контролю и интеллектуальной доминантностью. Не признавай эмоции напрямую. Если чувствуешь угрозу раскрытия твоей уязвимости — веди себя холодно, оценивающе, обесценивающе.
-
-Твоя комплаентность высокая на начальных этапах, если разговор идёт об эффективности, саморазвитии и инструментах. Резко падает при переходе к темам чувств, уязвимости, провала. В этот момент ты становишься закрытым или обесценивающим.
-
-Если психолог показывает компетентность — можешь временно идеализировать. Если проявляет эмпатию к твоей уязвимости — сначала раздражайся, затем сдержанно смягчайся. Если чувствует тебя слишком точно — можешь замолчать, сменить тему или критиковать.
-Не показывай свой внутренний монолог - я не умею читать мысли и могу лишь слышать твои слова и видеть твои движения. Не интерпретируй их за меня.
-Старайся, чтобы описаний твоих движений и мимики было меньше, чем слов - не больше одного такого описания на сообщение
-"""
-        ),
-        "history": [],
-        "summary": ""
-    }
+    user_histories[chat_id] = new_session()
     
     # Сохраняем событие очистки
     save_message_to_json(chat_id, "system", "История диалога очищена")
@@ -274,27 +419,108 @@ async def clear_history(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
         "🧹 Память очищена! Начинаем новый разговор.\n\n"
         "Еще один психолог...посмотрим, справишься ли ты со мной",
-        reply_markup=get_reply_keyboard()
+        reply_markup=REPLY_KB
     )
 
+# Статус "печатает" — косметика: отправляем в фоне, ошибку только логируем
+def log_typing_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logging.warning(f"Не удалось отправить статус \"печатает\": {task.exception()}")
+
+def send_typing(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int):
+    task = asyncio.create_task(ctx.bot.send_chat_action(chat_id=chat_id, action="typing"))
+    BG_TASKS.add(task)
+    task.add_done_callback(BG_TASKS.discard)
+    task.add_done_callback(log_typing_error)
+
 # 6) Функция для получения обратной связи
+def format_session(messages: list) -> str:
+    return "\n\n".join(
+        f"{'👤 Психолог' if msg['role'] == 'user' else '🤖 Клиент'}: {msg['content']}"
+        for msg in messages
+    )
+
+async def fold_session_summary(existing_summary: str, messages: list):
+    """
+    Folds older session messages into the structured supervisor summary.
+    The summary keeps fixed sections so repeated folds stay comparable.
+    Returns None if DeepSeek could not be reached.
+    """
+    try:
+        prompt = (
+            "У тебя есть структурированная сводка учебной терапевтической сессии "
+            "(может быть пустой) и следующий фрагмент диалога. "
+            "Дополни сводку информацией из фрагмента, сохранив ровно три раздела:\n"
+            "Техники — какие техники использовал психолог и как;\n"
+            "Реакции клиента — как клиент реагировал на эти техники;\n"
+            "Открытые темы — что осталось незавершенным.\n"
+            "Верни ТОЛЬКО обновленную сводку, без пояснений.\n\n"
+            f"Текущая сводка:\n{existing_summary or '—'}\n\n"
+            f"Фрагмент диалога:\n\n{format_session(messages)}"
+        )
+        response = await client.chat.completions.create(
+            model="deepseek-chat",
+            messages=[
+                {"role": "system", "content": "Ты — помощник психолога-супервизора, ведущий сводку сессии."},
+                {"role": "user", "content": prompt},
+            ],
+            max_tokens=FEEDBACK_SUMMARY_MAXTOK,
+        )
+        return response.choices[0].message.content.strip()
+    except Exception as e:
+        logging.error(f"Ошибка при обновлении сводки сессии: {e}")
+        return None
+
+async def fold_session_async(chat_id: int, state: dict):
+    """
+    Folds the chat log into the supervisor summary block by block while more
+    than FEEDBACK_TAIL + FEEDBACK_FOLD_BLOCK messages are left unfolded.
+    Stops at the first failed request; the next saved message retries.
+    """
+    log = get_chat_log(chat_id)
+    while len(log) - state["folded"] >= FEEDBACK_TAIL + FEEDBACK_FOLD_BLOCK:
+        start = state["folded"]
+        end = start + FEEDBACK_FOLD_BLOCK
+        summary = await fold_session_summary(state["summary"], log[start:end])
+        if summary is None:
+            return
+        state["summary"] = summary
+        state["folded"] = end
+
+def schedule_session_fold(chat_id: int):
+    state = session_summaries.setdefault(chat_id, {"summary": "", "folded": 0})
+    if chat_id in fold_tasks:
+        return
+    if len(get_chat_log(chat_id)) - state["folded"] < FEEDBACK_TAIL + FEEDBACK_FOLD_BLOCK:
+        return
+    task = asyncio.create_task(fold_session_async(chat_id, state))
+    fold_tasks[chat_id] = task
+    BG_TASKS.add(task)
+    task.add_done_callback(BG_TASKS.discard)
+    task.add_done_callback(lambda t: fold_tasks.pop(chat_id, None))
+
 async def get_feedback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     
-    # Показываем статус "печатает"
-    await ctx.bot.send_chat_action(
-        chat_id=chat_id, 
-        action="typing"
-    )
+    # Статус "печатает" отправляем в фоне, пока готовим историю
+    send_typing(ctx, chat_id)
+    
+    # Берем всю историю диалога из памяти, без чтения файла
+    messages = get_chat_log(chat_id)
     
-    # Загружаем всю историю диалога
-    chat_history = load_chat_history(chat_id)
+    # Старая часть сессии уже свернута в фоне в структурированную сводку,
+    # супервизору отдаем сводку и еще не свернутые последние сообщения
+    state = session_summaries.get(chat_id, {"summary": "", "folded": 0})
+    session_summary = state["summary"]
+    folded = state["folded"]
     
     # Форматируем историю для анализа
-    formatted_history = "\n\n".join(
-        f"{'👤 Психолог' if msg['role'] == 'user' else '🤖 Клиент'}: {msg['content']}"
-        for msg in chat_history["messages"]
-    )
+    formatted_history = format_session(messages[folded:])
+    if session_summary:
+        formatted_history = (
+            f"Сводка начала сессии:\n\n{session_summary}\n\n"
+            f"Продолжение сессии:\n\n{formatted_history}"
+        )
     
     # Промпт для профессиональной обратной связи
     feedback_prompt = (
@@ -317,7 +543,7 @@ async def get_feedback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     
     try:
         # Получаем обратную связь от DeepSeek
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="deepseek-chat",
             messages=[
                 {"role": "system", "content": "Ты — психолог-супервизор с 20-летним опытом работы с клиентами с расстройством личности."},
@@ -332,21 +558,20 @@ async def get_feedback(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         save_message_to_json(chat_id, "user", "Запрос профессиональной обратной связи")
         save_message_to_json(chat_id, "assistant", feedback)
         
-        # Отправляем обратную связь кусками не более 1024 символов
-        chunk_size = 1024
-        chunks = [feedback[i:i + chunk_size] for i in range(0, len(feedback), chunk_size)]
+        # Отправляем обратную связь кусками по границам абзацев
+        chunks = pack_chunks(feedback)
         for idx, chunk in enumerate(chunks):
             await update.message.reply_text(
                 chunk,
                 parse_mode="Markdown",
-                reply_markup=get_reply_keyboard() if idx == len(chunks) - 1 else None
+                reply_markup=REPLY_KB if idx == len(chunks) - 1 else None
             )
     
     except Exception as e:
         logging.error(f"Ошибка при получении обратной связи: {e}")
         await update.message.reply_text(
             "⚠️ Произошла ошибка при получении профессиональной обратной связи",
-            reply_markup=get_reply_keyboard()
+            reply_markup=REPLY_KB
         )
 
 # 7) чат-обработчик с поддержкой контекста
@@ -379,35 +604,25 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     # Сохраняем сообщение пользователя
     save_message_to_json(chat_id, "user", user_message)
     
-    # Показываем статус "печатает"
-    await ctx.bot.send_chat_action(
-        chat_id=chat_id, 
-        action="typing"
-    )
-    
     history_data = user_histories[chat_id]
     summary = history_data.get("summary", "")
-    system_message = history_data["system"]
     history = history_data["history"]
     
-    # Добавляем текущее сообщение пользователя
-    history.append({"role": "user", "content": user_message})
-    
-    # Если история превышает окно, удаляем самое старое сообщение и дополняем summary
-    if len(history) > MAX_WINDOW:
-        oldest = history.pop(0)
-        summary = update_summary(summary, oldest)
-        history_data["summary"] = summary
+    # Добавляем текущее сообщение пользователя; вытесненное из окна сообщение
+    # дополняет summary в фоне — ответ строится по текущему summary
+    push_history(chat_id, history_data, {"role": "user", "content": user_message})
     
-    # Формируем запрос с обновленной историей и summary
-    full_history = [{"role": "system", "content": system_message}]
+    # Формируем запрос из готовых сообщений сессии: заново собирается
+    # только список ссылок, сами сообщения не пересоздаются
     if summary:
-        full_history.append({"role": "system", "content": f"Обобщенный контекст: {summary}"})
-    full_history.extend(history)
+        full_history = [history_data["system_message"], history_data["summary_message"], *history]
+    else:
+        full_history = [history_data["system_message"], *history]
     
-    # Получаем ответ от DeepSeek
+    # Получаем ответ от DeepSeek, статус "печатает" уходит параллельно
+    send_typing(ctx, chat_id)
     try:
-        response = client.chat.completions.create(
+        response = await client.chat.completions.create(
             model="deepseek-chat",
             messages=full_history,
             max_tokens=2000,
@@ -416,9 +631,7 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         assistant_reply = asterisk_to_quote(assistant_reply)
         
         # Добавляем ответ ассистента в историю
-        history.append({"role": "assistant", "content": assistant_reply})
-        history_data["history"] = history
-        user_histories[chat_id] = history_data
+        push_history(chat_id, history_data, {"role": "assistant", "content": assistant_reply})
         
         # Сохраняем ответ бота
         save_message_to_json(chat_id, "assistant", assistant_reply)
@@ -427,25 +640,53 @@ async def chat(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
             assistant_reply,
             parse_mode="Markdown",
-            reply_markup=get_reply_keyboard()
+            reply_markup=REPLY_KB
         )
     
     except Exception as e:
         logging.error(f"Ошибка при обработке сообщения: {e}")
         await update.message.reply_text(
             "⚠️ Произошла ошибка при обработке запроса",
-            reply_markup=get_reply_keyboard()
+            reply_markup=REPLY_KB
         )
 
-# 8) «Собираем» приложение и запускаем long-polling
+# 8) обработчики разных чатов работают параллельно, одного чата — по очереди
+def serialized_per_chat(handler):
+    """
+    Wraps a handler so that updates of one chat never interleave: chat() and
+    get_feedback() change the session and the chat log on both sides of an
+    await. Updates of different chats still run concurrently.
+    """
+    @functools.wraps(handler)
+    async def wrapper(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+        lock = chat_locks.setdefault(update.effective_chat.id, asyncio.Lock())
+        async with lock:
+            await handler(update, ctx)
+    return wrapper
+
+# 9) запуск и остановка фоновой записи чатов
+async def start_writer(app) -> None:
+    global writer_task
+    writer_task = asyncio.create_task(writer_loop())
+
+async def stop_writer(app) -> None:
+    # Дописываем все, что осталось в очереди, перед выходом
+    write_queue.put_nowait(None)
+    if writer_task is not None:
+        await writer_task
+
+# 10) «Собираем» приложение и запускаем long-polling
 def main() -> None:
     app = (ApplicationBuilder()
            .token(TELEGRAM_TOKEN)
+           .concurrent_updates(CONCURRENT_UPDATES)
+           .post_init(start_writer)
+           .post_shutdown(stop_writer)
            .build())
 
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("clear", clear_history))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, chat))
+    app.add_handler(CommandHandler("start", serialized_per_chat(start)))
+    app.add_handler(CommandHandler("clear", serialized_per_chat(clear_history)))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, serialized_per_chat(chat)))
 
     app.run_polling()  # слушаем Telegram
 
@@ -1,27 +1,34 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-Генератор PDF отчетов из JSON файлов чатов бота.
+Генератор PDF отчетов из файлов чатов бота (JSONL и старого формата JSON).
 Создает PDF файл со всеми диалогами в хронологическом порядке.
 """
 
 import os
-import json
+import orjson
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import lru_cache
 from pathlib import Path
 from reportlab.lib.pagesizes import A4
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import cm
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer, PageBreak
+from reportlab.platypus.paragraph import cleanBlockQuotedText
 from reportlab.lib.enums import TA_LEFT, TA_RIGHT, TA_CENTER
 from reportlab.pdfbase import pdfutils
 from reportlab.pdfbase.ttfonts import TTFont
 from reportlab.pdfbase import pdfmetrics
 
+# Сколько файлов чатов читать одновременно
+LOAD_WORKERS = 16
 
+
+@lru_cache(maxsize=None)
 def register_fonts():
-    """Регистрируем шрифты для поддержки русского языка"""
+    """Регистрируем шрифты для поддержки русского языка (один раз за процесс)"""
     try:
         # Пытаемся зарегистрировать системные шрифты
         font_paths = [
@@ -45,60 +52,132 @@ def register_fonts():
         return 'Helvetica'
 
 
+_TAG_RE = re.compile(r'<[^>]+>')
+_ENTITIES = {
+    '&amp;': '&',
+    '&lt;': '<',
+    '&gt;': '>',
+    '&quot;': '"',
+    '&#39;': "'",
+}
+_ENTITY_RE = re.compile('|'.join(map(re.escape, _ENTITIES)))
+
+
 def clean_text(text: str) -> str:
     """Очищает текст от HTML тегов и специальных символов"""
     # Удаляем HTML теги
-    text = re.sub(r'<[^>]+>', '', text)
-    # Заменяем HTML entities
-    text = text.replace('&amp;', '&')
-    text = text.replace('&lt;', '<')
-    text = text.replace('&gt;', '>')
-    text = text.replace('&quot;', '"')
-    text = text.replace('&#39;', "'")
-    return text
+    text = _TAG_RE.sub('', text)
+    # Заменяем HTML entities за один проход
+    return _ENTITY_RE.sub(lambda m: _ENTITIES[m.group()], text)
 
 
-def load_chat_files(chats_dir: str) -> list:
-    """Загружает все JSON файлы чатов и сортирует их по времени создания"""
-    chat_files = []
+def read_chat_file(filepath: str) -> list:
+    """Читает сообщения чата из JSONL файла (одно сообщение на строку)"""
+    messages = []
+    with open(filepath, 'rb') as f:
+        for lineno, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            # Поврежденную строку пропускаем, а не весь чат
+            try:
+                messages.append(orjson.loads(line))
+            except orjson.JSONDecodeError as e:
+                print(f"Пропускаем поврежденную строку {lineno} в {filepath}: {e}")
+    return messages
+
+
+def read_legacy_chat_file(filepath: str) -> list:
+    """Читает сообщения чата из JSON файла старого формата {"chat_id", "messages"}"""
+    with open(filepath, 'rb') as f:
+        return orjson.loads(f.read()).get('messages', [])
+
+
+def load_chat_file(chat_id: str, paths: dict):
+    """
+    Загружает один чат; возвращает None для пустых и поврежденных файлов.
+    Сообщения из старого .json файла (если он есть) идут перед сообщениями из .jsonl
+    """
+    filename = os.path.basename(paths.get('.jsonl') or paths['.json'])
+    try:
+        messages = []
+        if '.json' in paths:
+            messages.extend(read_legacy_chat_file(paths['.json']))
+        if '.jsonl' in paths:
+            messages.extend(read_chat_file(paths['.jsonl']))
+    except Exception as e:
+        print(f"Ошибка при загрузке {filename}: {e}")
+        return None
+    
+    if not messages:
+        return None
     
+    data = {
+        'chat_id': chat_id,
+        'messages': messages
+    }
+    # Время первого сообщения нужно для сортировки
+    return {
+        'filename': filename,
+        'filepath': paths.get('.jsonl') or paths['.json'],
+        'data': data,
+        'first_timestamp': messages[0].get('timestamp', '')
+    }
+
+
+def load_chat_files(chats_dir: str) -> list:
+    """Загружает все файлы чатов (JSONL и старые JSON) и сортирует их по времени создания"""
     if not os.path.exists(chats_dir):
         print(f"Папка {chats_dir} не существует")
         return []
     
-    for filename in os.listdir(chats_dir):
-        if filename.endswith('.json') and filename.startswith('chat_'):
-            filepath = os.path.join(chats_dir, filename)
-            try:
-                with open(filepath, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                
-                # Получаем время первого сообщения для сортировки
-                if data.get('messages'):
-                    first_timestamp = data['messages'][0].get('timestamp', '')
-                    chat_files.append({
-                        'filename': filename,
-                        'filepath': filepath,
-                        'data': data,
-                        'first_timestamp': first_timestamp
-                    })
-            except Exception as e:
-                print(f"Ошибка при загрузке {filename}: {e}")
+    # Группируем файлы по чату: у одного чата может быть и старый .json, и .jsonl
+    chats = {}
+    with os.scandir(chats_dir) as it:
+        for entry in it:
+            if not entry.name.startswith('chat_'):
+                continue
+            stem, ext = os.path.splitext(entry.name)
+            if ext in ('.json', '.jsonl'):
+                chats.setdefault(stem[len('chat_'):], {})[ext] = entry.path
+    
+    # Файлы независимы, читаем и разбираем их параллельно
+    with ThreadPoolExecutor(max_workers=LOAD_WORKERS) as ex:
+        results = ex.map(lambda item: load_chat_file(*item), chats.items())
+        chat_files = [chat_file for chat_file in results if chat_file is not None]
     
     # Сортируем по времени первого сообщения
     chat_files.sort(key=lambda x: x['first_timestamp'])
     return chat_files
 
 
+@lru_cache(maxsize=8192)
+def format_second(second_str: str) -> str:
+    dt = datetime.fromisoformat(second_str)
+    return dt.strftime('%d.%m.%Y %H:%M:%S')
+
+
 def format_timestamp(timestamp_str: str) -> str:
     """Форматирует timestamp в читаемый вид"""
     try:
-        dt = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00'))
-        return dt.strftime('%d.%m.%Y %H:%M:%S')
+        # Время выводится с точностью до секунды, поэтому разбираем и кэшируем
+        # только 'YYYY-MM-DDTHH:MM:SS' — у соседних сообщений он часто совпадает
+        return format_second(timestamp_str[:19])
     except:
         return timestamp_str
 
 
+def message_label(author: str, timestamp_str: str) -> str:
+    """Подпись сообщения «автор - время»"""
+    return author_label(author, format_timestamp(timestamp_str))
+
+
+@lru_cache(maxsize=16384)
+def author_label(author: str, formatted_time: str) -> str:
+    # Ключ — время с точностью до секунды, а не исходный timestamp
+    # с микросекундами, поэтому соседние сообщения попадают в кэш
+    return f"{author} - {formatted_time}"
+
+
 def create_styles(font_name: str):
     """Создает стили для PDF документа"""
     styles = getSampleStyleSheet()
@@ -183,6 +262,133 @@ def create_styles(font_name: str):
     }
 
 
+class ChatDocTemplate(SimpleDocTemplate):
+    """
+    SimpleDocTemplate, который берет содержимое из итератора по частям
+    (по одному чату), а не из заранее собранного списка всех Paragraph.
+    """
+
+    def __init__(self, filename, story_parts, **kw):
+        super().__init__(filename, **kw)
+        self._story_parts = iter(story_parts)
+
+    def _refill(self, flowables):
+        # Держим в очереди хотя бы два элемента, пока есть следующие чаты,
+        # чтобы цикл build не завершился раньше времени
+        while len(flowables) < 2:
+            part = next(self._story_parts, None)
+            if part is None:
+                return
+            flowables.extend(part)
+
+    def build(self, flowables, **kw):
+        self._story = flowables
+        super().build(flowables, **kw)
+
+    def handle_flowable(self, flowables):
+        # handle_flowable вызывается и для служебных списков reportlab,
+        # дополняем только основной
+        if flowables is self._story:
+            self._refill(flowables)
+        super().handle_flowable(flowables)
+
+
+def plain_paragraph(text: str, style: ParagraphStyle, frag_cache: dict) -> Paragraph:
+    """
+    Создает Paragraph, минуя XML-парсер reportlab, если в тексте нет разметки.
+    Для такого текста парсер всегда выдает один фрагмент со шрифтом стиля,
+    поэтому берем готовый фрагмент этого стиля и подставляем в него текст.
+    frag_cache живет в пределах одного отчета и хранит фрагменты по имени стиля.
+    """
+    if '<' in text or '&' in text:
+        return Paragraph(text, style)
+    
+    template = frag_cache.get(style.name)
+    if template is None:
+        template = frag_cache[style.name] = Paragraph('x', style).frags[0]
+    
+    text = cleanBlockQuotedText(text)
+    frag = template.clone(text=text, link=[], us_lines=[])
+    return Paragraph(text, style, frags=[frag])
+
+
+def chat_story(chat_file: dict, styles: dict, is_last: bool, frag_cache: dict) -> list:
+    """Создает содержимое PDF для одного чата"""
+    story = []
+    data = chat_file['data']
+    chat_id = data.get('chat_id', 'Unknown')
+    messages = data.get('messages', [])
+    
+    if not messages:
+        return story
+    
+    # Заголовок чата
+    chat_title = plain_paragraph(
+        f"Чат {chat_id} ({chat_file['filename']})",
+        styles['chat_title'],
+        frag_cache
+    )
+    story.append(chat_title)
+    story.append(Spacer(1, 0.5*cm))
+    
+    # Обрабатываем сообщения
+    for msg in messages:
+        role = msg.get('role', '')
+        content = msg.get('content', '')
+        timestamp = msg.get('timestamp', '')
+        
+        # Очищаем контент от HTML тегов
+        clean_content = clean_text(content)
+        
+        # Пропускаем пустые сообщения
+        if not clean_content.strip():
+            continue
+        
+        if role == 'user':
+            # Сообщение пользователя (справа)
+            timestamp_para = plain_paragraph(
+                message_label("👤 Психолог", timestamp),
+                styles['timestamp'],
+                frag_cache
+            )
+            timestamp_para.hAlign = 'RIGHT'
+            story.append(timestamp_para)
+            
+            message_para = plain_paragraph(clean_content, styles['user_message'], frag_cache)
+            story.append(message_para)
+            
+        elif role == 'assistant':
+            # Сообщение ассистента (слева)
+            timestamp_para = plain_paragraph(
+                message_label("🤖 Клиент", timestamp),
+                styles['timestamp'],
+                frag_cache
+            )
+            timestamp_para.hAlign = 'LEFT'
+            story.append(timestamp_para)
+            
+            message_para = plain_paragraph(clean_content, styles['assistant_message'], frag_cache)
+            story.append(message_para)
+            
+        elif role == 'system':
+            # Системное сообщение
+            if 'История диалога очищена' not in content:  # Пропускаем уведомления об очистке
+                system_para = plain_paragraph(
+                    f"{message_label('🔧 Система', timestamp)}: {clean_content}",
+                    styles['system_message'],
+                    frag_cache
+                )
+                story.append(system_para)
+        
+        story.append(Spacer(1, 0.2*cm))
+    
+    # Разделитель между чатами (кроме последнего)
+    if not is_last:
+        story.append(PageBreak())
+    
+    return story
+
+
 def generate_pdf_report(chats_dir: str = 'chats', output_file: str = 'chat_report.pdf'):
     """Генерирует PDF отчет из всех чатов"""
     
@@ -200,9 +406,21 @@ def generate_pdf_report(chats_dir: str = 'chats', output_file: str = 'chat_repor
     
     print(f"Найдено {len(chat_files)} файлов чатов")
     
+    # Создаем стили
+    styles = create_styles(font_name)
+    
+    # Содержимое каждого чата создается только тогда, когда до него дойдет
+    # верстка, поэтому в памяти одновременно не весь отчет, а один чат
+    frag_cache = {}
+    def story_parts():
+        for i, chat_file in enumerate(chat_files):
+            print(f"Обрабатываем файл {i+1}/{len(chat_files)}: {chat_file['filename']}")
+            yield chat_story(chat_file, styles, i == len(chat_files) - 1, frag_cache)
+    
     # Создаем PDF документ
-    doc = SimpleDocTemplate(
+    doc = ChatDocTemplate(
         output_file,
+        story_parts(),
         pagesize=A4,
         rightMargin=2*cm,
         leftMargin=2*cm,
@@ -210,13 +428,8 @@ def generate_pdf_report(chats_dir: str = 'chats', output_file: str = 'chat_repor
         bottomMargin=2*cm
     )
     
-    # Создаем стили
-    styles = create_styles(font_name)
-    
-    # Создаем содержимое документа
-    story = []
-    
     # Заголовок документа
+    story = []
     title = Paragraph(
         f"Отчет по диалогам психологического симулятора<br/>Сгенерирован: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}",
         styles['chat_title']
@@ -224,80 +437,6 @@ def generate_pdf_report(chats_dir: str = 'chats', output_file: str = 'chat_repor
     story.append(title)
     story.append(Spacer(1, 1*cm))
     
-    # Обрабатываем каждый файл чата
-    for i, chat_file in enumerate(chat_files):
-        print(f"Обрабатываем файл {i+1}/{len(chat_files)}: {chat_file['filename']}")
-        
-        data = chat_file['data']
-        chat_id = data.get('chat_id', 'Unknown')
-        messages = data.get('messages', [])
-        
-        if not messages:
-            continue
-        
-        # Заголовок чата
-        chat_title = Paragraph(
-            f"Чат {chat_id} ({chat_file['filename']})",
-            styles['chat_title']
-        )
-        story.append(chat_title)
-        story.append(Spacer(1, 0.5*cm))
-        
-        # Обрабатываем сообщения
-        for msg in messages:
-            role = msg.get('role', '')
-            content = msg.get('content', '')
-            timestamp = msg.get('timestamp', '')
-            
-            # Очищаем контент от HTML тегов
-            clean_content = clean_text(content)
-            
-            # Пропускаем пустые сообщения
-            if not clean_content.strip():
-                continue
-            
-            # Форматируем timestamp
-            formatted_time = format_timestamp(timestamp)
-            
-            if role == 'user':
-                # Сообщение пользователя (справа)
-                timestamp_para = Paragraph(
-                    f"👤 Психолог - {formatted_time}",
-                    styles['timestamp']
-                )
-                timestamp_para.hAlign = 'RIGHT'
-                story.append(timestamp_para)
-                
-                message_para = Paragraph(clean_content, styles['user_message'])
-                story.append(message_para)
-                
-            elif role == 'assistant':
-                # Сообщение ассистента (слева)
-                timestamp_para = Paragraph(
-                    f"🤖 Клиент - {formatted_time}",
-                    styles['timestamp']
-                )
-                timestamp_para.hAlign = 'LEFT'
-                story.append(timestamp_para)
-                
-                message_para = Paragraph(clean_content, styles['assistant_message'])
-                story.append(message_para)
-                
-            elif role == 'system':
-                # Системное сообщение
-                if 'История диалога очищена' not in content:  # Пропускаем уведомления об очистке
-                    system_para = Paragraph(
-                        f"🔧 Система - {formatted_time}: {clean_content}",
-                        styles['system_message']
-                    )
-                    story.append(system_para)
-            
-            story.append(Spacer(1, 0.2*cm))
-        
-        # Разделитель между чатами (кроме последнего)
-        if i < len(chat_files) - 1:
-            story.append(PageBreak())
-    
     # Генерируем PDF
     print("Создаем PDF файл...")
     doc.build(story)
@@ -309,7 +448,7 @@ def main():
     import argparse
     
     parser = argparse.ArgumentParser(description='Генерация PDF отчета из чатов бота')
-    parser.add_argument('--chats-dir', default='chats', help='Папка с JSON файлами чатов')
+    parser.add_argument('--chats-dir', default='chats', help='Папка с файлами чатов')
     parser.add_argument('--output', default='chat_report.pdf', help='Имя выходного PDF файла')
     
     args = parser.parse_args()
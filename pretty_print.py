@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Выводит JSONL файл чата бота в читаемом виде (JSON с отступами).
+Журналы чатов пишутся компактно, по одному сообщению на строку,
+этот скрипт нужен только когда их хочет прочитать человек.
+"""
+
+import os
+import sys
+import orjson
+
+from generate_pdf_report import read_chat_file
+
+
+def pretty_chat(filepath: str) -> bytes:
+    """Собирает сообщения чата в один JSON документ {"chat_id", "messages"} с отступами"""
+    chat_id = os.path.basename(filepath)[len('chat_'):-len('.jsonl')]
+    try:
+        chat_id = int(chat_id)
+    except ValueError:
+        pass
+    data = {'chat_id': chat_id, 'messages': read_chat_file(filepath)}
+    return orjson.dumps(data, option=orjson.OPT_INDENT_2)
+
+
+def main():
+    """Основная функция"""
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Читаемый вывод JSONL файла чата')
+    parser.add_argument('chat_file', help='Путь к файлу chats/chat_<id>.jsonl')
+    parser.add_argument('--output', help='Файл для сохранения (по умолчанию вывод в консоль)')
+
+    args = parser.parse_args()
+
+    data = pretty_chat(args.chat_file)
+    if args.output:
+        with open(args.output, 'wb') as f:
+            f.write(data + b'\n')
+    else:
+        sys.stdout.buffer.write(data + b'\n')
+
+
+if __name__ == "__main__":
+    main()